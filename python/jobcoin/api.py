@@ -1,21 +1,28 @@
-import re
+import functools
+import sys
 import urllib.parse
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timezone
 from decimal import Decimal
 from fractions import Fraction
 from typing import (
     List,
+    Mapping,
     NamedTuple,
     Optional,
     Protocol,
     Sequence,
     Tuple,
     TypedDict,
+    TypeVar,
     Union,
     cast,
 )
 
-from aiohttp import ClientSession
+import httpx
+import orjson
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from aiohttp.web import HTTPException
 
 from . import config
@@ -60,11 +67,15 @@ class Transaction(NamedTuple):
 
     @staticmethod
     def from_raw(raw_transaction: RawTransactionT) -> "Transaction":
+        # Every poll of the house address re-parses its entire history, so without
+        # interning, we'd hold a fresh copy of each address per transaction per poll
+        from_addr = cast(Optional[str], raw_transaction.get("fromAddress")) or None
+
         return Transaction(
             timestamp=str2iso(raw_transaction["timestamp"]),
-            from_addr=cast(Optional[str], raw_transaction.get("fromAddress")) or None,
-            to_addr=raw_transaction["toAddress"],
-            amount=Fraction(raw_transaction["amount"]),
+            from_addr=None if from_addr is None else sys.intern(from_addr),
+            to_addr=sys.intern(raw_transaction["toAddress"]),
+            amount=str2frac(raw_transaction["amount"]),
         )
 
     def to_raw(self) -> RawTransactionT:
@@ -94,12 +105,20 @@ class Balance(NamedTuple):
     def from_raw(addr: AddrT, raw_balance: RawBalanceT) -> "Balance":
         return Balance(
             addr=addr,
-            balance=Fraction(raw_balance["balance"]),
+            balance=str2frac(raw_balance["balance"]),
             transactions=tuple(
                 Transaction.from_raw(t) for t in raw_balance["transactions"]
             ),
         )
 
+    def since(self, since: Optional[datetime]) -> "Balance":
+        if since is None:
+            return self
+
+        return self._replace(
+            transactions=tuple(t for t in self.transactions if t.timestamp >= since)
+        )
+
 
 class Config(Protocol):
     API_ADDRESS_URL: str
@@ -110,14 +129,80 @@ class InsufficientFundsError(Exception):
     pass
 
 
-class Api:
+@functools.lru_cache(maxsize=1024)
+def address_url(template: str, addr: AddrT) -> str:
+    return template.format(addr=urllib.parse.quote(addr, safe=""))
+
+
+def since_params(since: Optional[datetime]) -> Optional[Mapping[str, str]]:
+    # Asking for only transactions at or after since requires a companion change on the
+    # server (which is free to ignore the parameter, in which case we filter on our end
+    # after the fact)
+    return None if since is None else {"since": iso2str(since)}
+
+
+# We (de)serialize payloads ourselves with orjson, which is considerably faster than the
+# standard library's json module on large transaction lists
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def transfer_payload(from_addr: AddrT, to_addr: AddrT, amount: Fraction) -> bytes:
+    return orjson.dumps(
+        {
+            "toAddress": to_addr,
+            "fromAddress": from_addr,
+            "amount": frac2str(amount),
+        }
+    )
+
+
+def pooled_client_session() -> ClientSession:
+    # Every request goes to the same host, so we want to hang on to (and reuse)
+    # connections rather than paying for a fresh TCP+TLS handshake each poll.
+    # Note that aiohttp expects this to be called from within a running event loop.
+    return ClientSession(
+        connector=TCPConnector(
+            limit=100,
+            limit_per_host=32,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        ),
+        timeout=ClientTimeout(total=30),
+    )
+
+
+_ApiT = TypeVar("_ApiT", bound="BaseApi")
+
+
+class BaseApi(ABC):
+    # What Api and HttpxApi have in common, aside from the HTTP client each is built
+    # around. Callers that don't care which they get (e.g., gather_deposits_task or
+    # disburse_task) should expect one of these.
+
+    # How many complete balances to hang on to for revalidating with their ETags. Each
+    # holds its address's entire history, so we only keep the most recently used (zero
+    # turns caching off).
+    balance_cache_size = 64
+
     def __init__(
         self,
-        client: ClientSession,
         config: Config = cast(Config, config),  # pylint: disable=redefined-outer-name
     ):
-        self.client = client
         self.config = config
+        # Maps address URLs to the ETag and Balance from the last time we fetched them,
+        # least recently used first
+        self.balance_cache: "OrderedDict[str, Tuple[str, Balance]]" = OrderedDict()
+
+    async def __aenter__(self: _ApiT) -> _ApiT:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @abstractmethod
+    async def close(self) -> None:
+        raise NotImplementedError
 
     def now(self) -> datetime:
         # This is an odd place for this, but we need some way to replace the notion of
@@ -127,21 +212,101 @@ class Api:
     async def get_balance_for_address(
         self,
         addr: AddrT,
+        since: Optional[datetime] = None,
     ) -> Balance:
+        url = address_url(self.config.API_ADDRESS_URL, addr)
+        # If the server gave us an ETag the last time we asked for this (complete)
+        # balance, we ask it not to bother sending it again if it hasn't changed
+        cached = self.balance_cache.get(url) if since is None else None
+        fetched = await self.fetch_balance(
+            url, since, None if cached is None else cached[0]
+        )
+
+        if fetched is None:
+            assert cached is not None
+            self.balance_cache.move_to_end(url)
+
+            return cached[1]
+
+        etag, raw_balance = fetched
+        balance = Balance.from_raw(addr, orjson.loads(raw_balance)).since(since)
+
+        if since is None and etag is not None and self.balance_cache_size > 0:
+            self.balance_cache[url] = (etag, balance)
+            self.balance_cache.move_to_end(url)
+
+            while len(self.balance_cache) > self.balance_cache_size:
+                self.balance_cache.popitem(last=False)
+
+        return balance
+
+    @abstractmethod
+    async def fetch_balance(
+        self,
+        url: str,
+        since: Optional[datetime],
+        etag: Optional[str],
+    ) -> Optional[Tuple[Optional[str], bytes]]:
+        # Returns the response's ETag (if any) and body, or None if the server says
+        # what we have for etag is still current
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_transactions(self) -> Sequence[Transaction]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def post_transfer(
+        self,
+        from_addr: AddrT,
+        to_addr: AddrT,
+        amount: Fraction,
+    ):
+        raise NotImplementedError
+
+
+class Api(BaseApi):
+    # The client session must outlive any tasks created with gather_deposits_task or
+    # disburse_task that use this object. The easiest way to ensure that is to use it
+    # as an async context manager, e.g.:
+    #
+    #   async with Api() as api:
+    #       tasks = [disburse_task(api, ...), ...]
+    #       await asyncio.gather(*tasks)
+    def __init__(
+        self,
+        client: Optional[ClientSession] = None,
+        config: Config = cast(Config, config),  # pylint: disable=redefined-outer-name
+    ):
+        super().__init__(config)
+        self.client = pooled_client_session() if client is None else client
+
+    async def close(self) -> None:
+        await self.client.close()
+
+    async def fetch_balance(
+        self,
+        url: str,
+        since: Optional[datetime],
+        etag: Optional[str],
+    ) -> Optional[Tuple[Optional[str], bytes]]:
         async with self.client.get(
-            self.config.API_ADDRESS_URL.format(addr=urllib.parse.quote(addr, safe="")),
+            url,
+            params=since_params(since),
+            headers=None if etag is None else {"If-None-Match": etag},
             raise_for_status=True,
         ) as resp:
-            raw_balance = await resp.json()
+            if resp.status == 304:
+                return None
 
-            return Balance.from_raw(addr, raw_balance)
+            return resp.headers.get("ETag"), await resp.read()
 
     async def get_transactions(self) -> Sequence[Transaction]:
         async with self.client.get(
             self.config.API_TRANSACTIONS_URL,
             raise_for_status=True,
         ) as resp:
-            raw_transactions = await resp.json()
+            raw_transactions = orjson.loads(await resp.read())
 
             return tuple(Transaction.from_raw(t) for t in raw_transactions)
 
@@ -153,11 +318,8 @@ class Api:
     ):
         async with self.client.post(
             self.config.API_TRANSACTIONS_URL,
-            json={
-                "toAddress": to_addr,
-                "fromAddress": from_addr,
-                "amount": frac2str(amount),
-            },
+            data=transfer_payload(from_addr, to_addr, amount),
+            headers=JSON_HEADERS,
         ) as resp:
             if resp.status == 422:
                 raise InsufficientFundsError
@@ -165,13 +327,136 @@ class Api:
                 raise resp
 
 
+def http2_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        timeout=30.0,
+    )
+
+
+class HttpxApi(BaseApi):
+    # An alternative to Api that speaks HTTP/2, which allows concurrent requests (e.g.,
+    # a burst of disbursements) to be multiplexed over a single connection rather than
+    # waiting on one another. As with Api, the client must outlive any tasks using this
+    # object.
+    def __init__(
+        self,
+        client: Optional[httpx.AsyncClient] = None,
+        config: Config = cast(Config, config),  # pylint: disable=redefined-outer-name
+    ):
+        super().__init__(config)
+        self.client = http2_client() if client is None else client
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def fetch_balance(
+        self,
+        url: str,
+        since: Optional[datetime],
+        etag: Optional[str],
+    ) -> Optional[Tuple[Optional[str], bytes]]:
+        resp = await self.client.get(
+            url,
+            params=since_params(since),
+            headers=None if etag is None else {"If-None-Match": etag},
+        )
+
+        if resp.status_code == 304:
+            return None
+
+        resp.raise_for_status()
+
+        return resp.headers.get("ETag"), resp.content
+
+    async def get_transactions(self) -> Sequence[Transaction]:
+        resp = await self.client.get(self.config.API_TRANSACTIONS_URL)
+        resp.raise_for_status()
+
+        return tuple(Transaction.from_raw(t) for t in orjson.loads(resp.content))
+
+    async def post_transfer(
+        self,
+        from_addr: AddrT,
+        to_addr: AddrT,
+        amount: Fraction,
+    ):
+        resp = await self.client.post(
+            self.config.API_TRANSACTIONS_URL,
+            content=transfer_payload(from_addr, to_addr, amount),
+            headers=JSON_HEADERS,
+        )
+
+        if resp.status_code == 422:
+            raise InsufficientFundsError
+
+        resp.raise_for_status()
+
+
 def frac2str(frac: Fraction) -> str:
-    return str(Decimal(frac.numerator) / Decimal(frac.denominator))
+    numerator, denominator = frac.numerator, frac.denominator
+
+    if denominator == 1:
+        return str(numerator)
+
+    # A (reduced) denominator of the form 2**twos * 5**fives (e.g., for anything that
+    # started life as a decimal numeral) can be scaled up to a power of ten, which
+    # allows formatting with integer operations alone. Anything else is a repeating
+    # decimal, so we resort to (inexact) Decimal division.
+    twos = fives = 0
+
+    while denominator % 2 == 0:
+        denominator //= 2
+        twos += 1
+
+    while denominator % 5 == 0:
+        denominator //= 5
+        fives += 1
+
+    if denominator != 1:
+        return str(Decimal(frac.numerator) / Decimal(frac.denominator))
+
+    places = max(twos, fives)
+    digits = str(abs(numerator) * 2 ** (places - twos) * 5 ** (places - fives))
+    digits = digits.rjust(places + 1, "0")
+
+    return "{}{}.{}".format(
+        "-" if numerator < 0 else "", digits[:-places], digits[-places:]
+    )
+
+
+def str2frac(frac_str: str) -> Fraction:
+    # Fraction's own string parsing goes through a regular expression, which is
+    # comparatively slow. Amounts always arrive as plain decimal numerals (an optional
+    # sign, then ASCII digits with at most one point between them), so we handle those
+    # directly and defer to Fraction for anything else. (We have to be strict here,
+    # since int is more forgiving than we can be, e.g., of whitespace or underscores,
+    # which would throw off our count of the places after the point.)
+    whole, dot, part = frac_str.partition(".")
+    whole_digits = whole[1:] if whole[:1] in ("-", "+") else whole
+
+    if (
+        whole_digits.isascii()
+        and whole_digits.isdigit()
+        and (not dot or (part.isascii() and part.isdigit()))
+    ):
+        return Fraction(int(whole + part), 10 ** len(part))
+
+    return Fraction(frac_str)
 
 
 def iso2str(dt: datetime) -> str:
-    return re.sub(r"[-+][0-9:]+\Z", r"Z", dt.isoformat(timespec="milliseconds"))
+    # With timespec="milliseconds", isoformat always starts with a fixed-width
+    # "YYYY-MM-DDTHH:MM:SS.sss", followed by an offset only if dt is aware
+    dt_str = dt.isoformat(timespec="milliseconds")
+
+    return dt_str if dt.utcoffset() is None else dt_str[:23] + "Z"
 
 
 def str2iso(dt_str: str) -> datetime:
-    return datetime.fromisoformat(str(re.sub(r"Z\Z", r"+00:00", dt_str)))
+    # datetime.fromisoformat doesn't understand "Z" until Python 3.11
+    if dt_str.endswith("Z"):
+        dt_str = dt_str[:-1] + "+00:00"
+
+    return datetime.fromisoformat(dt_str)
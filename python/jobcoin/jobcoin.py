@@ -2,18 +2,50 @@ import asyncio
 import logging
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal
 from fractions import Fraction
 from random import uniform
-from typing import DefaultDict, Dict, Mapping, NoReturn, Set
+from typing import (
+    DefaultDict,
+    Dict,
+    List,
+    Mapping,
+    NoReturn,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    runtime_checkable,
+)
 
-from .api import AddrT, Api, Transaction
+from .api import AddrT, BaseApi
 
 LOGGER = logging.getLogger()
 
+# Internally, the disburser keeps track of amounts as whole numbers of minor units
+# (think satoshis), which makes for much cheaper arithmetic than Fractions do
+MINOR_UNITS_PER_COIN = 10**8
+MINOR_UNITS_PER_CENT = MINOR_UNITS_PER_COIN // 100
+
+
+@runtime_checkable
+class Versioned(Protocol):
+    # Something whose version is bumped on every change (e.g., a recv_addr_to_wthd_addrs
+    # mapping passed to disburse_task), so that consumers can tell whether it has
+    # changed without having to compare its contents
+    version: int
+
+
+def coins2minor(amount: Fraction) -> int:
+    # Anything smaller than a minor unit is dropped (rounding toward negative infinity)
+    return amount.numerator * MINOR_UNITS_PER_COIN // amount.denominator
+
+
+def minor2coins(minor: int) -> Fraction:
+    return Fraction(minor, MINOR_UNITS_PER_COIN)
+
 
 def gather_deposits_task(
-    api: Api,
+    api: BaseApi,
     recv_addr: AddrT,
     house_addr: AddrT,
     poll_sec: float = 2.0 * 60,
@@ -31,8 +63,70 @@ def gather_deposits_task(
     return asyncio.create_task(_watcher(), name="gather_deposits_task")
 
 
+def gather_all_deposits_task(
+    api: BaseApi,
+    recv_addrs: Set[AddrT],
+    house_addr: AddrT,
+    poll_sec: float = 2.0 * 60,
+) -> asyncio.Task:
+    # This does the same job as one gather_deposits_task per receive address, but costs
+    # a single request per poll, regardless of how many receive addresses there are.
+    # recv_addrs may be added to while the task is running.
+    async def _watcher() -> NoReturn:
+        # We maintain running balances for our receive addresses by replaying the
+        # network's ledger. Like an address's transactions, the ledger is append-only,
+        # so we only need to replay what's new since our last run. We only keep
+        # balances for addresses we're watching, so memory doesn't grow with the rest
+        # of the network.
+        balances: Dict[AddrT, Fraction] = {}
+        replayed_count = 0
+
+        while True:
+            transactions = await api.get_transactions()
+            assert len(transactions) >= replayed_count
+            watched_addrs = set(recv_addrs)
+
+            for recv_addr in balances.keys() - watched_addrs:
+                del balances[recv_addr]
+
+            for recv_addr in watched_addrs - balances.keys():
+                # This is new since our last run, so it needs to catch up on what we've
+                # already replayed
+                balances[recv_addr] = Fraction(0)
+
+                for transaction in transactions[:replayed_count]:
+                    if transaction.from_addr == recv_addr:
+                        balances[recv_addr] -= transaction.amount
+
+                    if transaction.to_addr == recv_addr:
+                        balances[recv_addr] += transaction.amount
+
+            for transaction in transactions[replayed_count:]:
+                if transaction.from_addr in balances:
+                    balances[transaction.from_addr] -= transaction.amount
+
+                if transaction.to_addr in balances:
+                    balances[transaction.to_addr] += transaction.amount
+
+            replayed_count = len(transactions)
+
+            # Our transfers will show up in the ledger (and hence our balances) on our
+            # next run
+            await asyncio.gather(
+                *(
+                    api.post_transfer(recv_addr, house_addr, balance)
+                    for recv_addr, balance in balances.items()
+                    if balance > 0
+                )
+            )
+            await asyncio.sleep(poll_sec)
+
+    # create_task(..., name=...) requires Python >= 3.8
+    return asyncio.create_task(_watcher(), name="gather_all_deposits_task")
+
+
 def disburse_task(
-    api: Api,
+    api: BaseApi,
     house_addr: AddrT,
     recv_addr_to_wthd_addrs: Mapping[AddrT, Set[AddrT]],
     min_distinct_receiver_addrs: int = 20,
@@ -45,9 +139,25 @@ def disburse_task(
         # reconstruct our state from what we can observe in the network. Thankfully,
         # this is similar to what we have to do when detecting new deposits, but with
         # some additional housekeeping.
-        unpaid_receipts: DefaultDict[AddrT, Fraction] = defaultdict(Fraction)
-        reconciled_transactions: Set[Transaction] = set()
+        unpaid_receipts: DefaultDict[AddrT, int] = defaultdict(int)
+        # Deposits aren't required to be whole numbers of minor units, so we keep
+        # whatever's left over exactly (always less than one minor unit), and pay it
+        # out with the last split
+        unpaid_remainders: DefaultDict[AddrT, Fraction] = defaultdict(Fraction)
+        reconciled_through: Optional[datetime] = None
+        reconciled_at_hwm = 0
         newest_transaction_dt = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+        # The earliest we may disburse (only recomputed when newest_transaction_dt
+        # changes)
+        disburse_after = newest_transaction_dt + min_transaction_age
+        wthd_addr_to_recv_addr: Dict[AddrT, AddrT] = {}
+        wthd_addr_to_recv_addr_version: Optional[int] = None
+
+        def _owe(recv_addr: AddrT, amount: Fraction) -> None:
+            remainder = unpaid_remainders[recv_addr] + amount
+            minor = coins2minor(remainder)
+            unpaid_receipts[recv_addr] += minor
+            unpaid_remainders[recv_addr] = remainder - minor2coins(minor)
 
         while True:
             # Build a map back from withdrawal addresses to our receive address. This is
@@ -55,63 +165,93 @@ def disburse_task(
             # same withdrawal address with multiple receive addresses. While it's nice
             # to be able to recreate one's internal state entirely from the network,
             # these are not constraints one could rely on in the real world. Some
-            # reliably persisted local state would likely be prudent. We do this every
+            # reliably persisted local state would likely be prudent. We check every
             # iteration of the loop because recv_addr_to_wthd_addrs might have changed
-            # since we last ran.
-            wthd_addr_to_recv_addr: Dict[AddrT, AddrT] = {}
-
-            for recv_addr, wthd_addrs in recv_addr_to_wthd_addrs.items():
-                assert wthd_addrs
-
-                for wthd_addr in wthd_addrs:
-                    assert wthd_addr not in wthd_addr_to_recv_addr
-                    wthd_addr_to_recv_addr[wthd_addr] = recv_addr
-
-            house_balance = await api.get_balance_for_address(house_addr)
-
-            for transaction in house_balance.transactions:
-                if transaction not in reconciled_transactions:
-                    if (
-                        transaction.from_addr
-                        and transaction.from_addr in recv_addr_to_wthd_addrs
-                    ):
-                        assert transaction.to_addr == house_addr
-                        newest_transaction_dt = max(
-                            newest_transaction_dt,
-                            transaction.timestamp,
-                        )
-                        unpaid_receipts[transaction.from_addr] += transaction.amount
-                    elif transaction.to_addr in wthd_addr_to_recv_addr:
-                        assert transaction.from_addr == house_addr
-                        recv_addr = wthd_addr_to_recv_addr[transaction.to_addr]
-                        unpaid_receipts[recv_addr] -= transaction.amount
-                    else:
-                        LOGGER.warning(
-                            "ignoring transaction found that does not belong to a known receive or withdrawal address: %r",
-                            transaction,
-                        )
+            # since we last ran. If it's Versioned, we only rebuild when its version
+            # changes. Otherwise, we have no cheap way to detect changes, so we rebuild
+            # every time.
+            version = (
+                recv_addr_to_wthd_addrs.version
+                if isinstance(recv_addr_to_wthd_addrs, Versioned)
+                else None
+            )
+
+            if version is None or version != wthd_addr_to_recv_addr_version:
+                wthd_addr_to_recv_addr.clear()
+
+                for recv_addr, wthd_addrs in recv_addr_to_wthd_addrs.items():
+                    assert wthd_addrs
+
+                    for wthd_addr in wthd_addrs:
+                        assert wthd_addr not in wthd_addr_to_recv_addr
+                        wthd_addr_to_recv_addr[wthd_addr] = recv_addr
+
+                wthd_addr_to_recv_addr_version = version
+
+            # The API reports an address's transactions in the order they were made,
+            # and history is never rewritten, so we only need to ask for those at or
+            # after the newest one we've already seen. The first few of those (i.e.,
+            # the ones sharing that exact timestamp) have already been reconciled.
+            house_balance = await api.get_balance_for_address(
+                house_addr, since=reconciled_through
+            )
+            assert len(house_balance.transactions) >= reconciled_at_hwm
+
+            for transaction in house_balance.transactions[reconciled_at_hwm:]:
+                if (
+                    transaction.from_addr
+                    and transaction.from_addr in recv_addr_to_wthd_addrs
+                ):
+                    assert transaction.to_addr == house_addr
 
-                reconciled_transactions.add(transaction)
+                    if transaction.timestamp > newest_transaction_dt:
+                        newest_transaction_dt = transaction.timestamp
+                        disburse_after = newest_transaction_dt + min_transaction_age
 
-            # Clear out anyone who's been paid
-            cleaned_unpaid_receipts = {
-                recv_addr: balance_owed
+                    _owe(transaction.from_addr, transaction.amount)
+                elif transaction.to_addr in wthd_addr_to_recv_addr:
+                    assert transaction.from_addr == house_addr
+                    recv_addr = wthd_addr_to_recv_addr[transaction.to_addr]
+                    _owe(recv_addr, -transaction.amount)
+                else:
+                    LOGGER.warning(
+                        "ignoring transaction found that does not belong to a known receive or withdrawal address: %r",
+                        transaction,
+                    )
+
+            if house_balance.transactions:
+                reconciled_through = house_balance.transactions[-1].timestamp
+                reconciled_at_hwm = 0
+
+                for transaction in reversed(house_balance.transactions):
+                    if transaction.timestamp != reconciled_through:
+                        break
+
+                    reconciled_at_hwm += 1
+
+            # Clear out anyone who's been paid (we can't delete while iterating, so we
+            # collect the keys first)
+            for recv_addr in [
+                recv_addr
                 for recv_addr, balance_owed in unpaid_receipts.items()
-                if balance_owed != 0
-            }
-            unpaid_receipts.clear()
-            unpaid_receipts.update(cleaned_unpaid_receipts)
+                if balance_owed == 0 and unpaid_remainders[recv_addr] == 0
+            ]:
+                del unpaid_receipts[recv_addr]
+                del unpaid_remainders[recv_addr]
 
-            # We should always have enough in our balance to make our payouts. (Note:
-            # using sum(..., start=...) requires Python >= 3.8.)
-            total_unpaid = sum(unpaid_receipts.values(), start=Fraction(0))
-            assert total_unpaid <= house_balance.balance
+            # We should always have enough in our balance to make our payouts
+            surplus = (
+                house_balance.balance
+                - minor2coins(sum(unpaid_receipts.values()))
+                - sum(unpaid_remainders.values())
+            )
+            assert surplus >= 0
 
-            if house_balance.balance > total_unpaid:
+            if surplus > 0:
                 LOGGER.warning(
                     'Balance on "%s" shows a surplus of %s (probably a bug, not free money)',
                     house_addr,
-                    house_balance.balance - total_unpaid,
+                    surplus,
                 )
 
             # This is a toy attempt to try to accumulate a "sufficient" number of
@@ -124,42 +264,62 @@ def disburse_task(
             # in the payouts. They can trace and subtract their own transactions, which
             # likely leaves a much clearer picture around what's left. Collecting a fee
             # might present a disincentive for this kind of attack. I'm not sure it
-            # would eliminate it, though.
-            now = api.now()
-
+            # would eliminate it, though. (We only bother checking the time once we
+            # know we have enough receivers.)
             if (
                 len(unpaid_receipts) >= min_distinct_receiver_addrs
-                and now >= newest_transaction_dt + min_transaction_age
+                and api.now() >= disburse_after
             ):
+                # We compute all the splits up front so we can issue the transfers
+                # concurrently
+                pending: List[Tuple[AddrT, Fraction]] = []
+
                 for recv_addr, balance_owed in unpaid_receipts.items():
-                    wthd_addrs = recv_addr_to_wthd_addrs[recv_addr]
+                    wthd_addr_list = list(recv_addr_to_wthd_addrs[recv_addr])
                     # This could result in a repeating decimal, so we have to massage
-                    # some more
-                    split = balance_owed / len(wthd_addrs)
+                    # some more. We round each split (but the last) to whole cents (a
+                    # float is plenty precise for that), and the last withdrawal address
+                    # gets whatever remains.
+                    base_cents = (
+                        balance_owed / len(wthd_addr_list) / MINOR_UNITS_PER_CENT
+                    )
 
                     # We could introduce some randomization or jitter here in an attempt
                     # to obfuscate things, but I would hope that's beyond the scope of
                     # this already ridiculously cumbersome exercise
-                    base_value = Decimal(split.numerator) / Decimal(split.denominator)
-
-                    for i, wthd_addr in enumerate(wthd_addrs):
-                        if i < len(wthd_addrs) - 1:
-                            jitter_value = base_value * Decimal(uniform(0.9, 1.1))
-                            rounded_split = Fraction(
-                                jitter_value.quantize(Decimal("0.01"))
-                            )
-                            await api.post_transfer(
-                                house_addr, wthd_addr, rounded_split
-                            )
-                            balance_owed -= rounded_split
-                        else:
-                            await api.post_transfer(house_addr, wthd_addr, balance_owed)
-                            balance_owed = Fraction(0)
-
-                    # Note that we don't update unpaid_receipts here. We wait until our
-                    # next run to observe and reconcile the transactions we just
-                    # created.
-                    assert balance_owed == 0
+                    splits: List[int] = []
+                    balance_left = balance_owed
+
+                    for _ in range(len(wthd_addr_list) - 1):
+                        # With enough withdrawal addresses, the jitter could otherwise
+                        # overshoot what's owed, leaving the last one owing money
+                        split = min(
+                            round(base_cents * uniform(0.9, 1.1))
+                            * MINOR_UNITS_PER_CENT,
+                            balance_left,
+                        )
+                        splits.append(split)
+                        balance_left -= split
+
+                    splits.append(balance_left)
+                    amounts = [minor2coins(split) for split in splits]
+                    amounts[-1] += unpaid_remainders[recv_addr]
+                    # Once the clamping above kicks in, some might be left with
+                    # nothing, which isn't worth a transfer
+                    pending.extend(
+                        (wthd_addr, amount)
+                        for wthd_addr, amount in zip(wthd_addr_list, amounts)
+                        if amount > 0
+                    )
+
+                # Note that we don't update unpaid_receipts here. We wait until our next
+                # run to observe and reconcile the transactions we just created.
+                await asyncio.gather(
+                    *(
+                        api.post_transfer(house_addr, wthd_addr, amount)
+                        for wthd_addr, amount in pending
+                    )
+                )
 
             await asyncio.sleep(poll_sec)
 
@@ -1,11 +1,15 @@
-from datetime import datetime, timezone
+import json
+from datetime import datetime, timedelta, timezone
 from fractions import Fraction
 from typing import List, cast
 
 import pytest
+from aiohttp.test_utils import TestClient, TestServer
 
 from ..jobcoin.api import (
+    Api,
     Balance,
+    BaseApi,
     InsufficientFundsError,
     RawBalanceT,
     RawCreateTransactionT,
@@ -14,21 +18,64 @@ from ..jobcoin.api import (
     Transaction,
     frac2str,
     iso2str,
+    str2frac,
     str2iso,
 )
 from .utils import loop  # noqa: F401 # pylint: disable=unused-import
-from .utils import test_api
+from .utils import FakeDb, test_api, test_httpx_api
 
 
 def test_frac2str() -> None:
     for tenths in range(1, 10):
         assert frac2str(Fraction(tenths, 10)) == "0.{}".format(tenths)
 
+    for frac, frac_str in (
+        (Fraction(0), "0"),
+        (Fraction(-10), "-10"),
+        (Fraction(5035, 100), "50.35"),
+        (Fraction(-1, 2), "-0.5"),
+        (Fraction(3, 8), "0.375"),
+        (Fraction(1, 1000), "0.001"),
+        (Fraction(2, 3), "0.6666666666666666666666666667"),
+    ):
+        assert frac2str(frac) == frac_str
+
+
+def test_str2frac() -> None:
+    for frac_str, frac in (
+        ("0", Fraction(0)),
+        ("10", Fraction(10)),
+        ("-10", Fraction(-10)),
+        ("50.35", Fraction(5035, 100)),
+        ("-0.5", Fraction(-1, 2)),
+        (".25", Fraction(1, 4)),
+        ("5.", Fraction(5)),
+        ("1e-2", Fraction(1, 100)),
+        ("+1.5", Fraction(3, 2)),
+        # These aren't canonical, so they should get the same treatment Fraction
+        # gives them
+        ("1.5 ", Fraction(3, 2)),
+        ("1.5\n", Fraction(3, 2)),
+        (" 1.5", Fraction(3, 2)),
+        ("1.50_0", Fraction(3, 2)),
+        ("1_0.5", Fraction(21, 2)),
+        ("\u0661.5", Fraction(3, 2)),
+        ("1.\u0665", Fraction(3, 2)),
+    ):
+        assert str2frac(frac_str) == frac
+        assert str2frac(frac_str) == Fraction(frac_str)
+
+    for bad_str in ("1.-5", "1._5", "1.5_", "--1"):
+        with pytest.raises(ValueError):
+            str2frac(bad_str)
+
 
 def test_iso2str() -> None:
     dt = datetime(2021, 7, 1, 12, 34, 56, 789000, tzinfo=timezone.utc)
     assert iso2str(dt) == "2021-07-01T12:34:56.789Z"
     assert str2iso(iso2str(dt)) == dt
+    assert iso2str(dt.replace(tzinfo=None)) == "2021-07-01T12:34:56.789"
+    assert str2iso("2021-07-01T12:34:56.789+00:00") == dt
 
 
 def test_balance() -> None:
@@ -112,6 +159,12 @@ def test_transaction() -> None:
     ]
 
     assert [Transaction.from_raw(t) for t in raw_transactions] == transactions
+
+    # Addresses parsed from separate payloads should share the same string object
+    create_transaction, transfer_transaction = (
+        Transaction.from_raw(json.loads(json.dumps(t))) for t in raw_transactions
+    )
+    assert create_transaction.to_addr is transfer_transaction.from_addr
     assert [t.to_raw() for t in transactions] == raw_transactions
 
 
@@ -189,3 +242,162 @@ async def test_api_transactions_insufficient_funds(
 
     with pytest.raises(InsufficientFundsError):
         await api.post_transfer("BobsAddress", "AlicesAddress", Fraction(5))
+
+
+async def test_api_sub_minor_unit_transfer(
+    aiohttp_client,
+) -> None:
+    api = await test_api(aiohttp_client)
+    resp = await api.client.post(
+        "/transactions", json={"toAddress": "BobsAddress", "amount": "10"}
+    )
+    assert resp.status == 200
+
+    # Amounts finer than the fake server's minor units should still go through exactly
+    amount = Fraction(1000000001, 10**9)
+    await api.post_transfer("BobsAddress", "AlicesAddress", amount)
+
+    alice_balance = await api.get_balance_for_address("AlicesAddress")
+    assert alice_balance.balance == amount
+    bob_balance = await api.get_balance_for_address("BobsAddress")
+    assert bob_balance.balance == 10 - amount
+
+
+async def test_api_balances_since(
+    aiohttp_client,
+) -> None:
+    api = await test_api(aiohttp_client)
+    client = cast(TestClient, api.client)
+    fake_db: FakeDb = cast(TestServer, client.server).app["fake_db"]
+
+    for raw_transaction in (
+        {
+            "timestamp": "2014-04-22T13:10:01.210Z",
+            "toAddress": "BobsAddress",
+            "amount": "10",
+        },
+        {
+            "timestamp": "2014-04-23T18:25:43.511Z",
+            "fromAddress": "BobsAddress",
+            "toAddress": "AlicesAddress",
+            "amount": "5",
+        },
+    ):
+        fake_db.append_transaction_and_update_balances(
+            cast(RawTransactionT, raw_transaction)
+        )
+
+    bob_balance = await api.get_balance_for_address("BobsAddress")
+    assert len(bob_balance.transactions) == 2
+
+    for since, expected in (
+        (bob_balance.transactions[0].timestamp, bob_balance.transactions),
+        (bob_balance.transactions[1].timestamp, bob_balance.transactions[1:]),
+        (bob_balance.transactions[1].timestamp + timedelta(seconds=1), ()),
+    ):
+        bob_balance_since = await api.get_balance_for_address("BobsAddress", since)
+        assert bob_balance_since.balance == Fraction(5)
+        assert bob_balance_since.transactions == expected
+
+        # The server is free to ignore since, so we also filter on our end
+        assert bob_balance.since(since) == bob_balance_since
+
+
+async def test_api_balances_etag(
+    aiohttp_client,
+) -> None:
+    api = await test_api(aiohttp_client)
+
+    resp = await api.client.post(
+        "/transactions", json={"toAddress": "BobsAddress", "amount": "10"}
+    )
+    assert resp.status == 200
+
+    bob_balance = await api.get_balance_for_address("BobsAddress")
+    assert bob_balance.balance == Fraction(10)
+
+    # Nothing has changed, so the server should have told us to use what we have
+    assert await api.get_balance_for_address("BobsAddress") is bob_balance
+
+    await api.post_transfer("BobsAddress", "AlicesAddress", Fraction(5))
+
+    bob_balance = await api.get_balance_for_address("BobsAddress")
+    assert bob_balance.balance == Fraction(5)
+    assert len(bob_balance.transactions) == 2
+
+
+async def test_api_balance_cache_bound(
+    aiohttp_client,
+) -> None:
+    api = await test_api(aiohttp_client)
+    api.balance_cache_size = 2
+    addrs = ["AlicesAddress", "BobsAddress", "CarolsAddress"]
+
+    for addr in addrs:
+        await api.get_balance_for_address(addr)
+
+    # Only the most recently used should have been kept
+    assert [url.rsplit("/", 1)[-1] for url in api.balance_cache] == addrs[1:]
+
+    # A revalidated hit counts as a use, so it should outlast its neighbor
+    await api.get_balance_for_address("BobsAddress")
+    await api.get_balance_for_address("AlicesAddress")
+    assert [url.rsplit("/", 1)[-1] for url in api.balance_cache] == [
+        "BobsAddress",
+        "AlicesAddress",
+    ]
+
+    # Caching can be turned off altogether
+    api.balance_cache.clear()
+    api.balance_cache_size = 0
+    await api.get_balance_for_address("BobsAddress")
+    assert not api.balance_cache
+
+
+def test_base_api_is_abstract() -> None:
+    class IncompleteApi(BaseApi):
+        async def close(self) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteApi()  # type: ignore # pylint: disable=abstract-class-instantiated
+
+
+async def test_api_context_manager() -> None:
+    async with Api() as api:
+        assert not api.client.closed
+
+    assert api.client.closed
+
+
+async def test_httpx_api_balances() -> None:
+    async with await test_httpx_api() as api:
+        bob_balance = await api.get_balance_for_address("BobsAddress")
+        assert bob_balance.balance == Fraction(0)
+        assert len(bob_balance.transactions) == 0
+
+        resp = await api.client.post(
+            "/transactions", json={"toAddress": "BobsAddress", "amount": "10"}
+        )
+        assert resp.status_code == 200
+
+        await api.post_transfer("BobsAddress", "AlicesAddress", Fraction(5))
+
+        bob_balance = await api.get_balance_for_address("BobsAddress")
+        assert bob_balance.balance == Fraction(5)
+        assert len(bob_balance.transactions) == 2
+        assert await api.get_balance_for_address("BobsAddress") is bob_balance
+
+        alice_balance = await api.get_balance_for_address("AlicesAddress")
+        assert alice_balance.balance == Fraction(5)
+        assert len(alice_balance.transactions) == 1
+
+        transactions = await api.get_transactions()
+        assert len(transactions) == 2
+        transaction = transactions[-1]
+        assert transaction.to_addr == "AlicesAddress"
+        assert transaction.from_addr == "BobsAddress"
+        assert transaction.amount == Fraction(5)
+
+        with pytest.raises(InsufficientFundsError):
+            await api.post_transfer("BobsAddress", "AlicesAddress", Fraction(10))
@@ -1,11 +1,19 @@
 import asyncio
 from fractions import Fraction
-from typing import Mapping, Set
+from typing import Dict, Mapping, Set
 
 import pytest
 
+from ..jobcoin import jobcoin
 from ..jobcoin.api import AddrT
-from ..jobcoin.jobcoin import disburse_task, gather_deposits_task
+from ..jobcoin.jobcoin import (
+    MINOR_UNITS_PER_COIN,
+    coins2minor,
+    disburse_task,
+    gather_all_deposits_task,
+    gather_deposits_task,
+    minor2coins,
+)
 from .utils import loop  # noqa: F401 # pylint: disable=unused-import
 from .utils import test_api
 
@@ -36,6 +44,13 @@ def recv_addr_to_wthd_addrs() -> Mapping[AddrT, Set[AddrT]]:
     }
 
 
+def test_coins2minor() -> None:
+    assert coins2minor(Fraction(10)) == 10 * MINOR_UNITS_PER_COIN
+    assert coins2minor(Fraction(5035, 100)) == 5035 * MINOR_UNITS_PER_COIN // 100
+    assert coins2minor(Fraction(1, 3 * MINOR_UNITS_PER_COIN)) == 0
+    assert minor2coins(coins2minor(Fraction(3, 8))) == Fraction(3, 8)
+
+
 async def test_simple_gather_deposits(
     aiohttp_client,
 ) -> None:
@@ -71,6 +86,54 @@ async def test_simple_gather_deposits(
     await asyncio.gather(task, return_exceptions=True)
 
 
+async def test_simple_gather_all_deposits(
+    aiohttp_client,
+) -> None:
+    api = await test_api(aiohttp_client)
+
+    src_addr = "src-test"
+    resp = await api.client.post(
+        "/transactions", json={"toAddress": src_addr, "amount": "30"}
+    )
+    assert resp.status == 200
+
+    recv_addrs = {"recv-test-1", "recv-test-2"}
+    house_addr = "house-test"
+    task = gather_all_deposits_task(api, recv_addrs, house_addr)
+
+    for i in range(1, 3):
+        for recv_addr in sorted(recv_addrs):
+            await api.post_transfer(src_addr, recv_addr, Fraction(5))
+
+        await asyncio.sleep(3 * 60.0)
+
+        for recv_addr in recv_addrs:
+            recv_balance = await api.get_balance_for_address(recv_addr)
+            assert recv_balance.balance == 0
+            assert len(recv_balance.transactions) == 2 * i
+
+        house_balance = await api.get_balance_for_address(house_addr)
+        assert house_balance.balance == 10 * i
+        assert len(house_balance.transactions) == len(recv_addrs) * i
+
+    # Add a receive address (that was funded before we started watching it) while the
+    # task is running
+    await api.post_transfer(src_addr, "recv-test-3", Fraction(10))
+    await asyncio.sleep(3 * 60.0)
+    recv_balance = await api.get_balance_for_address("recv-test-3")
+    assert recv_balance.balance == 10
+
+    recv_addrs.add("recv-test-3")
+    await asyncio.sleep(3 * 60.0)
+    recv_balance = await api.get_balance_for_address("recv-test-3")
+    assert recv_balance.balance == 0
+    house_balance = await api.get_balance_for_address(house_addr)
+    assert house_balance.balance == 30
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
 async def test_complete_disbursement(
     aiohttp_client,
     recv_addr_to_wthd_addrs: Mapping[
@@ -281,6 +344,193 @@ async def test_disbursus_interruptus(
     await asyncio.gather(*gather_deposits_tasks, return_exceptions=True)
 
 
+async def test_disbursement_versioned_addrs(
+    aiohttp_client,
+) -> None:
+    class VersionedDict(Dict[AddrT, Set[AddrT]]):
+        version = 0
+        # disburse_task only iterates over the whole mapping when (re)building its
+        # reverse map, so we count that to see whether it's been skipped
+        items_calls = 0
+
+        def items(self):
+            self.items_calls += 1
+
+            return super().items()
+
+    api = await test_api(aiohttp_client)
+
+    src_addr = "src-test"
+    resp = await api.client.post(
+        "/transactions", json={"toAddress": src_addr, "amount": "20"}
+    )
+    assert resp.status == 200
+
+    house_addr = "house-test"
+    recv_addr_to_wthd_addrs = VersionedDict(
+        {"recv-1": {"recv-1-wthd-1", "recv-1-wthd-2"}}
+    )
+    tasks = [
+        gather_deposits_task(api, "recv-1", house_addr),
+        gather_deposits_task(api, "recv-2", house_addr),
+        disburse_task(
+            api,
+            house_addr,
+            recv_addr_to_wthd_addrs,
+            min_distinct_receiver_addrs=1,
+        ),
+    ]
+
+    await api.post_transfer(src_addr, "recv-1", Fraction(10))
+    await asyncio.sleep(63 * 60.0)
+    house_balance = await api.get_balance_for_address(house_addr)
+    assert house_balance.balance == 0
+
+    # The reverse map should have been built once, and then left alone for all the
+    # polls since, because the version never changed
+    assert recv_addr_to_wthd_addrs.items_calls == 1
+
+    # Changing the mapping without bumping the version shouldn't be noticed
+    recv_addr_to_wthd_addrs["recv-3"] = {"recv-3-wthd-1"}
+    await asyncio.sleep(3 * 60.0)
+    assert recv_addr_to_wthd_addrs.items_calls == 1
+    del recv_addr_to_wthd_addrs["recv-3"]
+
+    # Add a new receive address
+    recv_addr_to_wthd_addrs["recv-2"] = {"recv-2-wthd-1", "recv-2-wthd-2"}
+    recv_addr_to_wthd_addrs.version += 1
+
+    await api.post_transfer(src_addr, "recv-2", Fraction(10))
+    await asyncio.sleep(63 * 60.0)
+    house_balance = await api.get_balance_for_address(house_addr)
+    assert house_balance.balance == 0
+    assert recv_addr_to_wthd_addrs.items_calls == 2
+
+    for wthd_addrs in recv_addr_to_wthd_addrs.values():
+        total_wthd_balance = Fraction(0)
+
+        for wthd_addr in wthd_addrs:
+            wthd_balance = await api.get_balance_for_address(wthd_addr)
+            total_wthd_balance += wthd_balance.balance
+
+        assert total_wthd_balance == 10
+
+    # Make sure the disburser is still healthy (i.e., it hasn't tripped over payouts to
+    # withdrawal addresses it doesn't know about)
+    await asyncio.sleep(3 * 60.0)
+    assert not tasks[-1].done()
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def test_disbursement_sub_minor_unit_deposits(
+    aiohttp_client,
+    caplog,
+) -> None:
+    api = await test_api(aiohttp_client)
+
+    src_addr = "src-test"
+    resp = await api.client.post(
+        "/transactions", json={"toAddress": src_addr, "amount": "10"}
+    )
+    assert resp.status == 200
+
+    house_addr = "house-test"
+    recv_addr = "recv-1"
+    wthd_addrs = {"recv-1-wthd-1", "recv-1-wthd-2"}
+    tasks = [
+        gather_deposits_task(api, recv_addr, house_addr),
+        disburse_task(
+            api,
+            house_addr,
+            {recv_addr: wthd_addrs},
+            min_distinct_receiver_addrs=1,
+        ),
+    ]
+
+    # Each of these is a fraction of a minor unit over a whole number of them, and
+    # together those fractions add up to more than a minor unit
+    amount = Fraction("1.000000009")
+
+    for _ in range(3):
+        await api.post_transfer(src_addr, recv_addr, amount)
+        await asyncio.sleep(3 * 60.0)
+
+    await asyncio.sleep(61 * 60.0)
+    house_balance = await api.get_balance_for_address(house_addr)
+    assert house_balance.balance == 0
+    total_wthd_balance = Fraction(0)
+
+    for wthd_addr in wthd_addrs:
+        wthd_balance = await api.get_balance_for_address(wthd_addr)
+        total_wthd_balance += wthd_balance.balance
+
+    assert total_wthd_balance == 3 * amount
+
+    # Nothing should have been left behind in the house, and the disburser should still
+    # be healthy after reconciling its payouts
+    await asyncio.sleep(3 * 60.0)
+    assert not tasks[-1].done()
+    assert "surplus" not in caplog.text
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def test_disbursement_jitter_overshoot(
+    aiohttp_client,
+    monkeypatch,
+) -> None:
+    # Always jitter as high as possible, so that the splits would add up to more than
+    # what's owed if left unchecked
+    monkeypatch.setattr(jobcoin, "uniform", lambda low, high: high)
+    api = await test_api(aiohttp_client)
+
+    src_addr = "src-test"
+    resp = await api.client.post(
+        "/transactions", json={"toAddress": src_addr, "amount": "10"}
+    )
+    assert resp.status == 200
+
+    house_addr = "house-test"
+    recv_addr = "recv-1"
+    wthd_addrs = {f"recv-1-wthd-{i}" for i in range(1, 21)}
+    tasks = [
+        gather_deposits_task(api, recv_addr, house_addr),
+        disburse_task(
+            api,
+            house_addr,
+            {recv_addr: wthd_addrs},
+            min_distinct_receiver_addrs=1,
+        ),
+    ]
+
+    await api.post_transfer(src_addr, recv_addr, Fraction(10))
+    await asyncio.sleep(63 * 60.0)
+    house_balance = await api.get_balance_for_address(house_addr)
+    assert house_balance.balance == 0
+    total_wthd_balance = Fraction(0)
+
+    for wthd_addr in wthd_addrs:
+        wthd_balance = await api.get_balance_for_address(wthd_addr)
+        assert wthd_balance.balance >= 0
+        total_wthd_balance += wthd_balance.balance
+
+    assert total_wthd_balance == 10
+    await asyncio.sleep(3 * 60.0)
+    assert not tasks[-1].done()
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 _ = """
@@ -1,3 +1,8 @@
+import asyncio
+import json
+import re
+import sys
+from datetime import datetime, timezone
 from typing import List, cast
 
 import pytest
@@ -7,9 +12,32 @@ from ..jobcoin.api import (
     RawCreateTransactionT,
     RawTransactionT,
     RawTransferTransactionT,
+    str2iso,
 )
 from .utils import loop  # noqa: F401 # pylint: disable=unused-import
-from .utils import FakeDb, InsufficientFundsError, fake_client
+from .utils import (
+    FakeDb,
+    InsufficientFundsError,
+    fake_client,
+    fake_timestamp,
+    minor2str,
+    str2minor,
+)
+
+
+def test_minor2str() -> None:
+    for amount in (
+        "0",
+        "0.00000001",
+        "1",
+        "10",
+        "20.25",
+        "1234.56789012",
+        "1.000000001",
+    ):
+        assert minor2str(str2minor(amount)) == amount
+
+    assert minor2str(str2minor("1.000000001") - str2minor("0.000000001")) == "1"
 
 
 def test_fake_db() -> None:
@@ -41,13 +69,22 @@ def test_fake_db() -> None:
     assert fake_db.addresses == {
         "BobsAddress": {
             "balance": "20.25",
-            "transactions": transactions,
+            "transaction_indices": [0, 1],
         },
         "AlicesAddress": {
             "balance": "30.1",
-            "transactions": [transactions[-1]],
+            "transaction_indices": [1],
         },
     }
+    assert fake_db.raw_balance("BobsAddress") == {
+        "balance": "20.25",
+        "transactions": transactions,
+    }
+    assert fake_db.raw_balance("AlicesAddress") == {
+        "balance": "30.1",
+        "transactions": [transactions[-1]],
+    }
+    assert fake_db.raw_balance("CarolsAddress") == {"balance": "0", "transactions": []}
 
     with pytest.raises(InsufficientFundsError):
         fake_db.append_transaction_and_update_balances(
@@ -59,20 +96,76 @@ def test_fake_db() -> None:
             }
         )
 
+    assert fake_db.minor_balances == {
+        "BobsAddress": 2025000000,
+        "AlicesAddress": 3010000000,
+    }
+
     # Check that nothing changed
     assert fake_db.transactions == transactions
     assert fake_db.addresses == {
         "BobsAddress": {
             "balance": "20.25",
-            "transactions": transactions,
+            "transaction_indices": [0, 1],
         },
         "AlicesAddress": {
             "balance": "30.1",
-            "transactions": [transactions[-1]],
+            "transaction_indices": [1],
         },
     }
 
 
+def test_fake_db_extend_transactions() -> None:
+    fake_db = FakeDb([], {})
+    transactions: List[RawTransactionT] = [
+        cast(
+            RawCreateTransactionT,
+            {
+                "timestamp": "2014-04-22T13:10:01.210Z",
+                "toAddress": "Bob",
+                "amount": "50",
+            },
+        ),
+        cast(
+            RawTransferTransactionT,
+            {
+                "timestamp": "2014-04-23T18:25:43.511Z",
+                "fromAddress": "Bob",
+                "toAddress": "Alice",
+                "amount": "30.1",
+            },
+        ),
+        cast(
+            RawTransferTransactionT,
+            {
+                "timestamp": "2014-04-23T18:25:44.511Z",
+                "fromAddress": "Bob",
+                "toAddress": "Alice",
+                "amount": "20",
+            },
+        ),
+    ]
+
+    with pytest.raises(InsufficientFundsError):
+        fake_db.extend_transactions(transactions)
+
+    # Everything before the transaction that failed should stand
+    assert fake_db.transactions == transactions[:2]
+    assert fake_db.minor_balances == {"Bob": 1990000000, "Alice": 3010000000}
+    assert fake_db.addresses == {
+        "Bob": {"balance": "19.9", "transaction_indices": [0, 1]},
+        "Alice": {"balance": "30.1", "transaction_indices": [1]},
+    }
+
+
+def test_fake_timestamp() -> None:
+    before = datetime.now(tz=timezone.utc).replace(microsecond=0)
+    timestamp = fake_timestamp()
+    after = datetime.now(tz=timezone.utc)
+    assert re.match(r"\A\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z\Z", timestamp)
+    assert before <= str2iso(timestamp) <= after
+
+
 async def test_fake_transactions(
     aiohttp_client,
 ) -> None:
@@ -100,6 +193,23 @@ async def test_fake_transactions(
     assert transaction["toAddress"] == "BobsAddress"
     assert "timestamp" in transaction
 
+    # The serialized list should have been cached (and should be refreshed as soon as
+    # it's out of date)
+    cached_count, cached_body = fake_db.json_cache[None]
+    assert cached_count == 1
+    assert json.loads(cached_body) == data
+
+    resp = await client.post(
+        "/transactions", json={"toAddress": "AlicesAddress", "amount": "5"}
+    )
+    assert resp.status == 200
+
+    resp = await client.get("/transactions")
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data) == 2
+    assert fake_db.json_cache[None][0] == 2
+
 
 async def test_fake_transactions_insufficient_funds(
     aiohttp_client,
@@ -118,6 +228,46 @@ async def test_fake_transactions_insufficient_funds(
     assert fake_db.transactions == []
 
 
+async def test_fake_transactions_concurrent(
+    aiohttp_client,
+) -> None:
+    client = await fake_client(aiohttp_client)
+    fake_db: FakeDb = cast(TestServer, client.server).app["fake_db"]
+    resp = await client.post(
+        "/transactions", json={"toAddress": "BobsAddress", "amount": "10"}
+    )
+    assert resp.status == 200
+
+    # Only three of these can go through, but the fourth shouldn't hold up the fifth
+    resps = await asyncio.gather(
+        *(
+            client.post(
+                "/transactions",
+                json={
+                    "fromAddress": "BobsAddress",
+                    "toAddress": to_addr,
+                    "amount": amount,
+                },
+            )
+            for to_addr, amount in (
+                ("AlicesAddress", "3"),
+                ("CarolsAddress", "3"),
+                ("AlicesAddress", "3"),
+                ("CarolsAddress", "3"),
+                ("DavesAddress", "1"),
+            )
+        )
+    )
+    assert [resp.status for resp in resps] == [200, 200, 200, 422, 200]
+    assert len(fake_db.transactions) == 5
+    assert fake_db.minor_balances == {
+        "BobsAddress": 0,
+        "AlicesAddress": 600000000,
+        "CarolsAddress": 300000000,
+        "DavesAddress": 100000000,
+    }
+
+
 async def test_fake_addresses(
     aiohttp_client,
 ) -> None:
@@ -137,6 +287,8 @@ async def test_fake_addresses(
     assert resp.status == 200
     assert len(fake_db.addresses) == 1
     assert len(fake_db.transactions) == 1
+    # The address decoded from the request should have been interned
+    assert fake_db.transactions[0]["toAddress"] is sys.intern("BobsAddress")
 
     resp = await client.get("/addresses/BobsAddress")
     assert resp.status == 200
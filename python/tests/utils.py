@@ -1,22 +1,47 @@
-from datetime import datetime, timedelta, timezone
+import asyncio
+import contextlib
+import functools
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from decimal import Decimal
 from fractions import Fraction
-from typing import Dict, List, NamedTuple, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+    cast,
+)
 
 import async_solipsism
+import httpx
+import orjson
 import pytest
 from aiohttp import ClientSession, web
 from aiohttp.test_utils import TestClient
 
 from ..jobcoin.api import (
+    JSON_HEADERS,
     AddrT,
     Api,
     Config,
+    HttpxApi,
     InsufficientFundsError,
     RawBalanceT,
     RawTransactionT,
-    RawTransferTransactionT,
     frac2str,
-    iso2str,
+    str2frac,
+    str2iso,
 )
 
 
@@ -32,12 +57,15 @@ class TestApi(Api):
         config: Config = TestConfig(),
     ):
         super().__init__(cast(ClientSession, client), config)
-        self._created_at = super().now()
+        # Offsetting a POSIX timestamp and converting once is cheaper than building a
+        # timedelta and adding it to a datetime
+        self._t0 = super().now().timestamp()
+        # The loop doesn't change out from under us, so there's no need to look this
+        # up every time
+        self._loop_time = client.app.loop.time
 
     def now(self) -> datetime:
-        client = cast(TestClient, self.client)
-
-        return self._created_at + timedelta(seconds=client.app.loop.time())
+        return datetime.fromtimestamp(self._t0 + self._loop_time(), tz=timezone.utc)
 
 
 @pytest.fixture
@@ -51,48 +79,144 @@ def loop(mocker):
     as_loop.close()
 
 
-class FakeDb(NamedTuple):
-    transactions: List[RawTransactionT]
-    addresses: Dict[AddrT, RawBalanceT]
+# The fake server keeps balances as whole numbers of minor units, which is plenty
+# precise for almost all of our purposes and (unlike re-parsing balance strings every
+# time) cheap. Amounts finer than that are kept as exact (fractional) numbers of minor
+# units instead, since the real API doesn't turn them away.
+MINOR_UNIT_DIGITS = 8
+MinorT = Union[int, Fraction]
+
+
+@functools.lru_cache(maxsize=2048)
+def str2minor(amount: str) -> MinorT:
+    whole, _, part = amount.partition(".")
+
+    if len(part) > MINOR_UNIT_DIGITS:
+        return str2frac(amount) * 10**MINOR_UNIT_DIGITS
+
+    return int(whole + part.ljust(MINOR_UNIT_DIGITS, "0"))
+
+
+@functools.lru_cache(maxsize=1024)
+def minor2str(minor: MinorT) -> str:
+    if isinstance(minor, Fraction):
+        if minor.denominator != 1:
+            return frac2str(minor / 10**MINOR_UNIT_DIGITS)
+
+        minor = minor.numerator
+
+    # Decimal only needs to shift the exponent, where Fraction would reduce by the gcd
+    # (only for frac2str to scale it back up again)
+    minor_str = format(Decimal(minor).scaleb(-MINOR_UNIT_DIGITS), "f")
+
+    return minor_str.rstrip("0").rstrip(".") if "." in minor_str else minor_str
+
+
+# Rather than keeping its own list of (references to) transactions, each address keeps
+# the positions of its transactions in FakeDb.transactions, from which its RawBalanceT
+# is only assembled when someone asks for it
+FakeBalanceT = TypedDict(
+    "FakeBalanceT",
+    {
+        "balance": str,
+        "transaction_indices": List[int],
+    },
+)
+
+
+# dataclass(slots=True) requires Python >= 3.10, so we go without on older versions
+_FAKE_DB_DATACLASS_KW = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+# Compared by identity (each test has its own), as before
+@dataclass(eq=False, **_FAKE_DB_DATACLASS_KW)
+class FakeDb:
+    transactions: List[RawTransactionT] = field(default_factory=list)
+    addresses: Dict[AddrT, FakeBalanceT] = field(default_factory=dict)
+    minor_balances: Dict[AddrT, MinorT] = field(init=False)
+    # Serialized responses for the transactions list (keyed by None) and for each
+    # address, along with how many transactions each reflected when it was created
+    # (since transactions are append-only, that's enough to tell whether it's stale)
+    json_cache: Dict[Optional[AddrT], Tuple[int, bytes]] = field(
+        init=False, repr=False, default_factory=dict
+    )
+
+    def __post_init__(self):
+        self.minor_balances = {
+            addr: str2minor(balance["balance"])
+            for addr, balance in self.addresses.items()
+        }
+
+    def cached_json(
+        self, key: Optional[AddrT], transaction_count: int, make_obj: Callable[[], Any]
+    ) -> bytes:
+        cached = self.json_cache.get(key)
+
+        if cached is None or cached[0] != transaction_count:
+            cached = (transaction_count, orjson.dumps(make_obj()))
+            self.json_cache[key] = cached
+
+        return cached[1]
+
+    def raw_balance(self, addr: AddrT) -> RawBalanceT:
+        balance = self.addresses.get(addr)
+
+        if balance is None:
+            return {"balance": "0", "transactions": []}
+
+        transactions = self.transactions
+
+        return {
+            "balance": balance["balance"],
+            "transactions": [transactions[i] for i in balance["transaction_indices"]],
+        }
 
     def append_transaction_and_update_balances(self, transaction: RawTransactionT):
-        if "fromAddress" in transaction:
-            from_addr = cast(RawTransferTransactionT, transaction)["fromAddress"]
-            assert from_addr
-            self._append_transaction_to_addr(from_addr, transaction, is_from=True)
+        self.extend_transactions((transaction,))
 
-        self.transactions.append(transaction)
-        to_addr = transaction["toAddress"]
-        self._append_transaction_to_addr(to_addr, transaction)
+    def extend_transactions(self, transactions: Iterable[RawTransactionT]):
+        # Applies transactions in order until one can't be (in which case, those before
+        # it stand). Balance strings are only formatted once per affected address at
+        # the end, which is most of the savings for bulk loads.
+        affected: Set[AddrT] = set()
+        minor_balances = self.minor_balances
 
-    def _append_transaction_to_addr(
-        self, addr: AddrT, transaction: RawTransactionT, is_from: bool = False
-    ):
-        if addr in self.addresses:
-            balance = self.addresses[addr]
+        try:
+            for transaction in transactions:
+                from_addr = cast(Optional[str], transaction.get("fromAddress"))
+                to_addr = transaction["toAddress"]
+                amount = str2minor(transaction["amount"])
+                index = len(self.transactions)
 
-            if is_from:
-                new_balance = Fraction(balance["balance"]) - Fraction(
-                    transaction["amount"]
-                )
+                # Check everything before touching anything, so there's nothing to
+                # undo if we can't go through with it
+                if from_addr:
+                    from_minor = minor_balances.get(from_addr)
 
-                if new_balance < 0:
-                    raise InsufficientFundsError
-            else:
-                new_balance = Fraction(balance["balance"]) + Fraction(
-                    transaction["amount"]
-                )
+                    if from_minor is None or from_minor < amount:
+                        raise InsufficientFundsError
 
-            balance["balance"] = frac2str(new_balance)
-            self.addresses[addr]["transactions"].append(transaction)
-        else:
-            if is_from:
-                raise InsufficientFundsError
-            else:
-                self.addresses[addr] = {
-                    "balance": transaction["amount"],
-                    "transactions": [transaction],
-                }
+                    minor_balances[from_addr] = from_minor - amount
+                    self.addresses[from_addr]["transaction_indices"].append(index)
+                    affected.add(from_addr)
+
+                to_balance = self.addresses.get(to_addr)
+
+                if to_balance is None:
+                    minor_balances[to_addr] = amount
+                    self.addresses[to_addr] = {
+                        "balance": transaction["amount"],
+                        "transaction_indices": [index],
+                    }
+                else:
+                    minor_balances[to_addr] += amount
+                    to_balance["transaction_indices"].append(index)
+
+                self.transactions.append(transaction)
+                affected.add(to_addr)
+        finally:
+            for addr in affected:
+                self.addresses[addr]["balance"] = minor2str(minor_balances[addr])
 
 
 async def fake_client(
@@ -100,6 +224,7 @@ async def fake_client(
 ) -> TestClient:
     app = web.Application()
     app["fake_db"] = FakeDb([], {})
+    app.cleanup_ctx.append(fake_commit_ctx)
     app.router.add_get("/addresses/{addr}", fake_addresses)
     app.router.add_get("/transactions", fake_transactions)
     app.router.add_post("/transactions", fake_transactions)
@@ -108,38 +233,241 @@ async def fake_client(
     return client
 
 
+def fake_timestamp() -> str:
+    # Equivalent to iso2str(datetime.now(tz=timezone.utc)), but without the datetime
+    return _ms2timestamp(time.time_ns() // 1_000_000)
+
+
+@functools.lru_cache(maxsize=1)
+def _ms2timestamp(ms: int) -> str:
+    # Timestamps only have millisecond resolution, so a burst of requests within the
+    # same one can all share the same string
+    secs, millis = divmod(ms, 1000)
+    now = time.gmtime(secs)
+
+    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}Z".format(
+        now.tm_year,
+        now.tm_mon,
+        now.tm_mday,
+        now.tm_hour,
+        now.tm_min,
+        now.tm_sec,
+        millis,
+    )
+
+
+class FakeResponse(NamedTuple):
+    status: int
+    body: Optional[bytes] = None
+    headers: Optional[Mapping[str, str]] = None
+
+
+# The following implement the fake API independently of any particular HTTP
+# library, so that the same logic can sit behind both fake_client and
+# fake_httpx_transport
+
+
+def fake_get_transactions(fake_db: FakeDb) -> FakeResponse:
+    return FakeResponse(
+        200,
+        fake_db.cached_json(
+            None, len(fake_db.transactions), lambda: fake_db.transactions
+        ),
+    )
+
+
+FAKE_POST_OK = FakeResponse(200, orjson.dumps({"status": "OK"}))
+FAKE_POST_INSUFFICIENT_FUNDS = FakeResponse(
+    422, orjson.dumps({"error": "Insufficient Funds"})
+)
+
+
+def fake_new_transaction(transaction: Dict[str, str]) -> RawTransactionT:
+    transaction["timestamp"] = fake_timestamp()
+    # JSON decoding gives us new strings for every request. Interning them means
+    # FakeDb stores one copy per address, and its dict lookups can match on identity.
+    transaction["toAddress"] = sys.intern(transaction["toAddress"])
+
+    if "fromAddress" in transaction:
+        transaction["fromAddress"] = sys.intern(transaction["fromAddress"])
+
+    return cast(RawTransactionT, transaction)
+
+
+def fake_post_transaction(fake_db: FakeDb, transaction: Dict[str, str]) -> FakeResponse:
+    try:
+        fake_db.append_transaction_and_update_balances(
+            fake_new_transaction(transaction)
+        )
+    except InsufficientFundsError:
+        return FAKE_POST_INSUFFICIENT_FUNDS
+    else:
+        return FAKE_POST_OK
+
+
+# The most queued POSTs fake_commit_task will apply in one go
+FAKE_COMMIT_BATCH_SIZE = 64
+
+
+async def fake_commit_task(
+    fake_db: FakeDb, queue: "asyncio.Queue[Tuple[RawTransactionT, asyncio.Future]]"
+):
+    # The single writer behind fake_client's POSTs. Rather than each handler updating
+    # fake_db on its own, whatever has piled up in the queue in the meantime is applied
+    # in one pass, after which each handler's future is resolved with its response.
+    while True:
+        batch = [await queue.get()]
+
+        while len(batch) < FAKE_COMMIT_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        while batch:
+            transaction_count = len(fake_db.transactions)
+            failure: Optional[Exception] = None
+
+            try:
+                fake_db.extend_transactions(t for t, _ in batch)
+            except Exception as exc:  # pylint: disable=broad-except
+                failure = exc
+
+            # Everything before the first transaction that couldn't be applied was
+            # applied, and everything after it still needs to be
+            applied = len(fake_db.transactions) - transaction_count
+
+            for _, future in batch[:applied]:
+                if not future.done():
+                    future.set_result(FAKE_POST_OK)
+
+            if failure is not None:
+                _, future = batch[applied]
+
+                if not future.done():
+                    if isinstance(failure, InsufficientFundsError):
+                        future.set_result(FAKE_POST_INSUFFICIENT_FUNDS)
+                    else:
+                        future.set_exception(failure)
+
+                applied += 1
+
+            del batch[:applied]
+
+
+async def fake_commit_ctx(app: web.Application):
+    queue: "asyncio.Queue[Tuple[RawTransactionT, asyncio.Future]]" = asyncio.Queue()
+    app["fake_commit_queue"] = queue
+    commit_task = asyncio.ensure_future(fake_commit_task(app["fake_db"], queue))
+
+    yield
+
+    commit_task.cancel()
+
+    with contextlib.suppress(asyncio.CancelledError):
+        await commit_task
+
+
+def fake_get_address(
+    fake_db: FakeDb,
+    addr: AddrT,
+    query: Mapping[str, str],
+    headers: Mapping[str, str],
+) -> FakeResponse:
+    if "since" in query:
+        # This is the companion to Api.get_balance_for_address(..., since=...)
+        since = str2iso(query["since"])
+        raw_balance = fake_db.raw_balance(addr)
+        raw_balance = {
+            "balance": raw_balance["balance"],
+            "transactions": [
+                t
+                for t in raw_balance["transactions"]
+                if str2iso(t["timestamp"]) >= since
+            ],
+        }
+
+        return FakeResponse(200, orjson.dumps(raw_balance))
+
+    # An address's transactions are append-only, so their number makes for a fine ETag
+    balance = fake_db.addresses.get(addr)
+    transaction_count = 0 if balance is None else len(balance["transaction_indices"])
+    etag = '"{}"'.format(transaction_count)
+
+    if headers.get("If-None-Match") == etag:
+        return FakeResponse(304, headers={"ETag": etag})
+
+    return FakeResponse(
+        200,
+        fake_db.cached_json(addr, transaction_count, lambda: fake_db.raw_balance(addr)),
+        {"ETag": etag},
+    )
+
+
+def aiohttp_response(fake_resp: FakeResponse) -> web.Response:
+    return web.Response(
+        status=fake_resp.status,
+        body=fake_resp.body,
+        headers=fake_resp.headers,
+        content_type=None if fake_resp.body is None else "application/json",
+    )
+
+
 async def fake_transactions(request: web.Request):
-    assert "fake_db" in request.app
     fake_db: FakeDb = request.app["fake_db"]
 
     if request.method == "GET":
-        return web.json_response(fake_db.transactions)
+        return aiohttp_response(fake_get_transactions(fake_db))
     elif request.method == "POST":
-        now = datetime.now(tz=timezone.utc)
-        timestamp = iso2str(now)
-        transaction = await request.json()
-        transaction["timestamp"] = timestamp
+        transaction = fake_new_transaction(orjson.loads(await request.read()))
+        future = asyncio.get_running_loop().create_future()
+        request.app["fake_commit_queue"].put_nowait((transaction, future))
 
-        try:
-            fake_db.append_transaction_and_update_balances(transaction)
-        except InsufficientFundsError:
-            return web.json_response({"error": "Insufficient Funds"}, status=422)
-        else:
-            return web.json_response({"status": "OK"})
+        return aiohttp_response(await future)
 
 
 async def fake_addresses(request: web.Request):
     assert request.method == "GET"
-    assert "fake_db" in request.app
     fake_db: FakeDb = request.app["fake_db"]
-    addr = request.match_info["addr"]
-    raw_balance: RawBalanceT = (
-        fake_db.addresses[addr]
-        if addr in fake_db.addresses
-        else {"balance": "0", "transactions": []}
+
+    return aiohttp_response(
+        fake_get_address(
+            fake_db, request.match_info["addr"], request.query, request.headers
+        )
     )
 
-    return web.json_response(raw_balance)
+
+def fake_httpx_transport(fake_db: FakeDb) -> httpx.MockTransport:
+    # A stand-in for fake_client that serves the same API directly to an
+    # httpx.AsyncClient (sans network)
+    def _handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+
+        if path == TestConfig.API_TRANSACTIONS_URL:
+            if request.method == "GET":
+                fake_resp = fake_get_transactions(fake_db)
+            else:
+                assert request.method == "POST"
+                fake_resp = fake_post_transaction(
+                    fake_db, orjson.loads(request.content)
+                )
+        else:
+            prefix = TestConfig.API_ADDRESS_URL.format(addr="")
+            prefix_len = len(prefix)
+            assert request.method == "GET"
+            assert path.startswith(prefix)
+            fake_resp = fake_get_address(
+                fake_db,
+                path[prefix_len:],
+                request.url.params,
+                request.headers,
+            )
+
+        headers = dict(fake_resp.headers or {})
+
+        if fake_resp.body is not None:
+            headers.update(JSON_HEADERS)
+
+        return httpx.Response(fake_resp.status, content=fake_resp.body, headers=headers)
+
+    return httpx.MockTransport(_handler)
 
 
 async def test_api(
@@ -148,3 +476,12 @@ async def test_api(
     client = await fake_client(aiohttp_client)
 
     return TestApi(client)
+
+
+async def test_httpx_api() -> HttpxApi:
+    client = httpx.AsyncClient(
+        base_url="http://fake",
+        transport=fake_httpx_transport(FakeDb([], {})),
+    )
+
+    return HttpxApi(client, TestConfig())